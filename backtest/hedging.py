@@ -0,0 +1,160 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Iterable, Optional, Tuple, Type
+
+
+# ---------------------------------------------------------
+# Whisper / GPT 呼び出しのヘッジ（tail latency 対策）
+# ---------------------------------------------------------
+def _percentile(values: Iterable[float], p: float) -> Optional[float]:
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def _cancel_all(tasks: Iterable["asyncio.Task"]) -> None:
+    """未完了のタスクをキャンセルし、HTTPリクエストが閉じるまで待つ。"""
+    tasks = list(tasks)
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class HedgedCaller:
+    """
+    1つのステージ（Whisper, 整形GPT など）の非同期呼び出しをラップするクラス。
+    - 直近のレイテンシの percentile を超えても返ってこない場合、同じリクエストを
+      もう1本（ヘッジ）投げ、先に返ってきた方を採用する。負けた方は task.cancel() で
+      HTTPリクエストごと止める。
+    - ヘッジ数は直近 window 回の呼び出しの budget_ratio 割合を超えない。
+    - retry_on の例外は締め切り内で max_attempts 回まで指数バックオフでリトライする。
+      （SDK 側のリトライは切っておくこと）
+    - deadline_sec を超えたら実行中のリクエストをキャンセルして TimeoutError。
+    call_fn は引数なしで API を叩くコルーチン関数。ヘッジやリトライのたびに呼ばれるので、
+    ファイルを送る場合は call_fn の中で毎回 open すること。
+    work は入力の大きさ（音声なら MB など）。ヘッジ判定は「秒 / work」の分布で行う。
+    """
+
+    def __init__(self, name: str, deadline_sec: float, percentile: float = 0.95,
+                 min_samples: int = 20, window: int = 200, budget_ratio: float = 0.1,
+                 max_attempts: int = 3, backoff_sec: float = 1.0,
+                 retry_on: Tuple[Type[BaseException], ...] = ()):
+        self.name = name
+        self.deadline_sec = deadline_sec
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget_ratio = budget_ratio
+        self.max_attempts = max_attempts
+        self.backoff_sec = backoff_sec
+        self.retry_on = retry_on
+        # ヘッジ判定用（成功した呼び出しの 秒/work）
+        self._latencies = deque(maxlen=window)
+        # メトリクス用（タイムアウト・エラーも含む全呼び出しの秒数）
+        self._outcomes = deque(maxlen=window)
+        # ヘッジ予算用（直近の呼び出しごとにヘッジしたかどうか）
+        self._hedged = deque(maxlen=window)
+        self._inflight_hedges = 0
+        self._calls = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+        self._retries = 0
+        self._timeouts = 0
+
+    def _hedge_delay(self, work: float) -> Optional[float]:
+        """直近レイテンシの percentile * work。サンプル不足ならヘッジしない(None)。"""
+        if len(self._latencies) < self.min_samples:
+            return None
+        return _percentile(self._latencies, self.percentile) * work
+
+    def _try_reserve_hedge(self) -> bool:
+        used = sum(self._hedged) + self._inflight_hedges
+        if used + 1 > self.budget_ratio * (len(self._hedged) + 1):
+            return False
+        self._inflight_hedges += 1
+        self._hedges += 1
+        return True
+
+    async def _attempts(self, call_fn: Callable[[], Awaitable[Any]], deadline: float) -> Any:
+        attempt = 1
+        while True:
+            try:
+                return await call_fn()
+            except self.retry_on as e:
+                delay = self.backoff_sec * (2 ** (attempt - 1))
+                if attempt >= self.max_attempts or time.monotonic() + delay >= deadline:
+                    raise
+                print(f"[HedgedCaller:{self.name}] {type(e).__name__} -> {delay:.1f}s 後にリトライ "
+                      f"({attempt}/{self.max_attempts})")
+                self._retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def call(self, call_fn: Callable[[], Awaitable[Any]], work: float = 1.0) -> Any:
+        start = time.monotonic()
+        deadline = start + self.deadline_sec
+        self._calls += 1
+
+        primary = asyncio.create_task(self._attempts(call_fn, deadline))
+        pending = {primary}
+        hedge = None
+        try:
+            hedge_delay = self._hedge_delay(work)
+            if hedge_delay is not None and hedge_delay < self.deadline_sec:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+                if not done and self._try_reserve_hedge():
+                    print(f"[HedgedCaller:{self.name}] {hedge_delay:.1f}s 超過 -> ヘッジ送信")
+                    hedge = asyncio.create_task(self._attempts(call_fn, deadline))
+                    pending.add(hedge)
+
+            last_error = None
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        continue
+                    elapsed = time.monotonic() - start
+                    self._latencies.append(elapsed / work)
+                    self._outcomes.append(elapsed)
+                    if task is hedge:
+                        self._hedge_wins += 1
+                    return task.result()
+
+            if last_error is not None and not pending:
+                self._outcomes.append(time.monotonic() - start)
+                raise last_error
+            self._outcomes.append(self.deadline_sec)
+            self._timeouts += 1
+            raise TimeoutError(f"{self.name}: {self.deadline_sec}s 以内に応答がありませんでした")
+        finally:
+            # 負けた方・締め切りを過ぎた方はここでキャンセルされる
+            await _cancel_all(t for t in (primary, hedge) if t is not None)
+            if hedge is not None:
+                self._inflight_hedges -= 1
+            self._hedged.append(hedge is not None)
+
+    def metrics(self) -> dict:
+        def pct(p: float) -> Optional[float]:
+            value = _percentile(self._outcomes, p)
+            return None if value is None else round(value, 3)
+
+        calls, hedges = self._calls, self._hedges
+        return {
+            "calls": calls,
+            "hedges": hedges,
+            "hedge_wins": self._hedge_wins,
+            "retries": self._retries,
+            "timeouts": self._timeouts,
+            "hedge_rate": hedges / calls if calls else 0.0,
+            "win_rate": self._hedge_wins / hedges if hedges else 0.0,
+            "p50_sec": pct(0.5),
+            "p99_sec": pct(0.99),
+        }
@@ -7,9 +7,11 @@ import shutil
 import json
 import requests
 import uvicorn
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, RateLimitError, InternalServerError, APIConnectionError
 from typing import Optional, Dict, Any, List
 
+from hedging import HedgedCaller
+
 # pydubで大容量ファイルを分割
 from pydub import AudioSegment
 
@@ -34,6 +36,64 @@ SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 SUPABASE_TABLE = os.getenv("SUPABASE_TABLE")
 
 client = OpenAI(api_key=OPENAI_API_KEY)
+# Whisper / GPT 用。キャンセルで HTTP リクエストを止められるよう非同期クライアントを使う。
+# リトライは HedgedCaller が締め切り内で行うので SDK のリトライは切る。
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+
+# ---------------------------------------------------------
+# 0) Whisper / GPT 呼び出しのヘッジ（tail latency 対策）
+# ---------------------------------------------------------
+# ステージごとの締め切り（秒）。超えたら 504。
+WHISPER_DEADLINE_SEC = float(os.getenv("WHISPER_DEADLINE_SEC", "300"))
+GPT_DEADLINE_SEC = float(os.getenv("GPT_DEADLINE_SEC", "180"))
+# 追加で投げるヘッジの上限（直近の呼び出し数に対する割合）
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.1"))
+# リトライする例外（429, 5xx, 接続エラー・タイムアウト）
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+
+def _hedged_caller(name: str, deadline_sec: float) -> HedgedCaller:
+    return HedgedCaller(name, deadline_sec, budget_ratio=HEDGE_BUDGET_RATIO,
+                        retry_on=RETRYABLE_ERRORS)
+
+
+# ステージごとにレイテンシ分布が違うので、それぞれ別に学習させる。
+# Whisper は音声の長さで時間が変わるので、ファイルサイズ(MB)あたりで学習する。
+hedged_callers = {
+    "whisper": _hedged_caller("whisper", WHISPER_DEADLINE_SEC),
+    "partial_summary": _hedged_caller("partial_summary", GPT_DEADLINE_SEC),
+    "combine_summary": _hedged_caller("combine_summary", GPT_DEADLINE_SEC),
+    "proofreading": _hedged_caller("proofreading", GPT_DEADLINE_SEC),
+    "analysis": _hedged_caller("analysis", GPT_DEADLINE_SEC),
+    "chatbot": _hedged_caller("chatbot", GPT_DEADLINE_SEC),
+}
+
+
+async def whisper_transcribe(path: str) -> str:
+    """ファイルパスを受け取り Whisper(language="ja") で文字起こし。"""
+    async def _call() -> str:
+        with open(path, "rb") as f_in:
+            return await async_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=f_in,
+                response_format="text",
+                language="ja"
+            )
+    # 小さいファイルは固定のオーバーヘッドが支配的なので 1MB を下限にする
+    work = max(os.path.getsize(path) / (1024 * 1024), 1.0)
+    return await hedged_callers["whisper"].call(_call, work=work)
+
+
+async def gpt_chat(stage: str, **kwargs) -> Any:
+    """chat.completions.create を stage のヘッジ設定で呼ぶ。"""
+    return await hedged_callers[stage].call(
+        lambda: async_client.chat.completions.create(**kwargs)
+    )
+
+
+def deadline_exceeded(e: TimeoutError) -> HTTPException:
+    return HTTPException(status_code=504, detail=str(e))
 
 
 # ---------------------------------------------------------
@@ -65,7 +125,7 @@ def chunk_text_by_length(text: str, chunk_size: int = 3000) -> List[str]:
     return chunks
 
 
-def partial_summary_gpt(chunk_text: str) -> str:
+async def partial_summary_gpt(chunk_text: str) -> str:
     """
     1つのテキストチャンクを要約するGPT呼び出し。
     トークンオーバー回避のため max_tokens を小さめに。
@@ -77,7 +137,8 @@ def partial_summary_gpt(chunk_text: str) -> str:
 {chunk_text}
 """
     print("\n[partial_summary_gpt] === CALLING GPT with prompt ===\n", prompt)
-    res = client.chat.completions.create(
+    res = await gpt_chat(
+        "partial_summary",
         model="gpt-4-turbo",
         messages=[{"role": "user", "content": prompt}],
         temperature=0.3,
@@ -89,7 +150,7 @@ def partial_summary_gpt(chunk_text: str) -> str:
     return summary_text
 
 
-def combine_summaries_with_gpt(summaries: List[str]) -> str:
+async def combine_summaries_with_gpt(summaries: List[str]) -> str:
     """
     複数の部分要約を再度まとめて「最終要約」にするGPT呼び出し。
     """
@@ -103,7 +164,8 @@ def combine_summaries_with_gpt(summaries: List[str]) -> str:
 出力はなるべく簡潔かつ重要事項が漏れないようにしてください:
 """
     print("\n[combine_summaries_with_gpt] === CALLING GPT with prompt ===\n", prompt)
-    res = client.chat.completions.create(
+    res = await gpt_chat(
+        "combine_summary",
         model="gpt-4-turbo",
         messages=[{"role": "user", "content": prompt}],
         temperature=0.3,
@@ -118,7 +180,7 @@ def combine_summaries_with_gpt(summaries: List[str]) -> str:
 # ---------------------------------------------------------
 # 2) 議事録生成ロジック
 # ---------------------------------------------------------
-def generate_minutes_from_text(transcript_text: str) -> dict:
+async def generate_minutes_from_text(transcript_text: str) -> dict:
     """
     1) Proofreading（整形） -> formatted_transcript
     2) （実質）全体要約で long_summary を作る
@@ -156,7 +218,8 @@ def generate_minutes_from_text(transcript_text: str) -> dict:
             {transcript_text}
             """
     print("\n[generate_minutes_from_text] === CALLING GPT for Proofreading Prompt ===\n", proofreading_prompt)
-    proofreading_res = client.chat.completions.create(
+    proofreading_res = await gpt_chat(
+        "proofreading",
         model="gpt-4-turbo",
         messages=[{"role": "user", "content": proofreading_prompt}],
         temperature=0.1,
@@ -172,9 +235,9 @@ def generate_minutes_from_text(transcript_text: str) -> dict:
         partials = []
         for i, chunk in enumerate(chunked_texts):
             print(f"[generate_minutes_from_text] Partial summary chunk {i+1}/{len(chunked_texts)}")
-            partial_sum = partial_summary_gpt(chunk)
+            partial_sum = await partial_summary_gpt(chunk)
             partials.append(partial_sum)
-        long_summary = combine_summaries_with_gpt(partials)
+        long_summary = await combine_summaries_with_gpt(partials)
     else:
         long_summary = formatted_transcript
 
@@ -306,7 +369,8 @@ def generate_minutes_from_text(transcript_text: str) -> dict:
             }}
             """
     print("\n[generate_minutes_from_text] === CALLING GPT for Final JSON ===\n", analysis_prompt)
-    final_res = client.chat.completions.create(
+    final_res = await gpt_chat(
+        "analysis",
         model="gpt-4-turbo",
         messages=[{"role": "user", "content": analysis_prompt}],
         temperature=0.2,
@@ -363,13 +427,7 @@ async def transcribe(audio: UploadFile = File(...)):
         # language="ja"指定で日本語認識精度アップを期待
         if file_size <= 25 * 1024 * 1024:
             print("[/transcribe] => 25MB以下: Whisperを1回だけ実行")
-            with open(temp_path, "rb") as f_in:
-                transcript_response = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=f_in,
-                    response_format="text",
-                    language="ja"
-                )
+            transcript_response = await whisper_transcribe(temp_path)
             print("[/transcribe] Whisper response:\n", transcript_response)
             transcript = transcript_response
         else:
@@ -386,24 +444,23 @@ async def transcribe(audio: UploadFile = File(...)):
                 print(f"[/transcribe] => chunk export idx={idx}, {start_ms}~{end_ms}ms => {chunk_path}")
                 chunk.export(chunk_path, format="mp3", bitrate="64k")
 
-                with open(chunk_path, "rb") as f_chunk:
-                    chunk_res = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=f_chunk,
-                        response_format="text",
-                        language="ja"
-                    )
+                try:
+                    chunk_res = await whisper_transcribe(chunk_path)
+                finally:
+                    os.remove(chunk_path)
                 print(f"[/transcribe] => chunk {idx} Whisper response:\n", chunk_res)
                 transcript += chunk_res + "\n"
-                os.remove(chunk_path)
                 idx += 1
                 start_ms = end_ms
 
         # 生成ロジック
-        result = generate_minutes_from_text(transcript)
+        result = await generate_minutes_from_text(transcript)
         print("[/transcribe] === Final Result ===\n", result)
         return result
 
+    except TimeoutError as e:
+        print("[/transcribe] タイムアウト:", e)
+        raise deadline_exceeded(e)
     except Exception as e:
         print("[/transcribe] エラー:", e)
         raise HTTPException(status_code=500, detail=str(e))
@@ -421,7 +478,11 @@ async def transcribe_text(payload: dict = Body(...)):
     print("\n[/transcribe-text] Raw input:\n", raw_text)
     if not raw_text.strip():
         raise HTTPException(status_code=400, detail="テキストが空です")
-    result = generate_minutes_from_text(raw_text)
+    try:
+        result = await generate_minutes_from_text(raw_text)
+    except TimeoutError as e:
+        print("[/transcribe-text] タイムアウト:", e)
+        raise deadline_exceeded(e)
     print("[/transcribe-text] => Final Result:\n", result)
     return result
 
@@ -439,24 +500,27 @@ async def transcribe_chunks(audios: list[UploadFile] = File(...)):
         if not ext:
             ext = ".webm"
         temp_path = f"./temp_audio_chunk_{idx}{ext}"
-        with open(temp_path, "wb") as f:
-            shutil.copyfileobj(audio.file, f)
-
-        with open(temp_path, "rb") as f_in:
-            chunk_res = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=f_in,
-                response_format="text",
-                language="ja"
-            )
+        try:
+            with open(temp_path, "wb") as f:
+                shutil.copyfileobj(audio.file, f)
+            chunk_res = await whisper_transcribe(temp_path)
+        except TimeoutError as e:
+            print(f"[/transcribe-chunks] => chunk {idx} タイムアウト:", e)
+            raise deadline_exceeded(e)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
         print(f"[/transcribe-chunks] => chunk {idx} Whisper response:\n", chunk_res)
         combined_transcript += chunk_res + "\n"
-        os.remove(temp_path)
 
     if not combined_transcript.strip():
         raise HTTPException(status_code=400, detail="音声チャンクの文字起こしに失敗しました")
 
-    result = generate_minutes_from_text(combined_transcript)
+    try:
+        result = await generate_minutes_from_text(combined_transcript)
+    except TimeoutError as e:
+        print("[/transcribe-chunks] タイムアウト:", e)
+        raise deadline_exceeded(e)
     print("[/transcribe-chunks] => Final Result:\n", result)
     return result
 
@@ -628,15 +692,20 @@ async def chatbot_query(payload: dict = Body(...)):
     print("\n[/chatbot] => GPT system_prompt:\n", system_prompt)
     print("[/chatbot] => GPT user_prompt:\n", user_prompt)
 
-    gpt_res = client.chat.completions.create(
-        model="gpt-4-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.7,
-        max_tokens=800
-    )
+    try:
+        gpt_res = await gpt_chat(
+            "chatbot",
+            model="gpt-4-turbo",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=0.7,
+            max_tokens=800
+        )
+    except TimeoutError as e:
+        print("[/chatbot] => タイムアウト:", e)
+        raise deadline_exceeded(e)
     print("[/chatbot] => GPT RAW RESPONSE:\n", gpt_res)
     answer_text = gpt_res.choices[0].message.content.strip()
 
@@ -644,6 +713,14 @@ async def chatbot_query(payload: dict = Body(...)):
     return {"response": answer_text}
 
 
+# ---------------------------------------------------------
+# /hedge-metrics (ヘッジ率・勝率・レイテンシ)
+# ---------------------------------------------------------
+@app.get("/hedge-metrics")
+async def hedge_metrics():
+    return {stage: caller.metrics() for stage, caller in hedged_callers.items()}
+
+
 # ---------------------------------------------------------
 # メイン起動
 # ---------------------------------------------------------
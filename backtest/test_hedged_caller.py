@@ -0,0 +1,225 @@
+import asyncio
+import time
+
+import pytest
+
+from hedging import HedgedCaller
+
+
+class Retryable(Exception):
+    pass
+
+
+class FakeCall:
+    """
+    HedgedCaller に渡す call_fn の代わり。
+    呼ばれた順番(0=プライマリ, 1=ヘッジ or リトライ)ごとに behaviors の関数を実行し、
+    キャンセルされた呼び出しの番号を cancelled に記録する。
+    """
+
+    def __init__(self, *behaviors):
+        self.behaviors = behaviors
+        self.count = 0
+        self.cancelled = []
+
+    async def __call__(self):
+        idx = self.count
+        self.count += 1
+        try:
+            return await self.behaviors[min(idx, len(self.behaviors) - 1)](idx)
+        except asyncio.CancelledError:
+            self.cancelled.append(idx)
+            raise
+
+
+async def fast(idx):
+    await asyncio.sleep(0.01)
+    return f"fast-{idx}"
+
+
+async def slow(idx):
+    await asyncio.sleep(0.1)
+    return f"slow-{idx}"
+
+
+async def stall(idx):
+    await asyncio.sleep(5)
+    return f"stalled-{idx}"
+
+
+async def fail_soon(idx):
+    await asyncio.sleep(0.05)
+    raise ValueError(f"fail-{idx}")
+
+
+async def boom(idx):
+    raise ValueError("boom")
+
+
+async def busy(idx):
+    raise Retryable()
+
+
+def make_caller(**kwargs):
+    params = dict(deadline_sec=5, min_samples=5, budget_ratio=1.0, backoff_sec=0.01)
+    params.update(kwargs)
+    return HedgedCaller("t", **params)
+
+
+async def prime(caller, n):
+    for _ in range(n):
+        await caller.call(FakeCall(fast))
+
+
+def test_no_hedge_before_min_samples():
+    async def run():
+        caller = make_caller()
+        for _ in range(4):
+            fake = FakeCall(slow)
+            assert await caller.call(fake) == "slow-0"
+            assert fake.count == 1
+        assert caller.metrics()["hedges"] == 0
+
+    asyncio.run(run())
+
+
+def test_hedge_wins_and_primary_is_cancelled():
+    async def run():
+        caller = make_caller()
+        await prime(caller, 5)
+        fake = FakeCall(stall, fast)
+        start = time.monotonic()
+        assert await caller.call(fake) == "fast-1"
+        assert time.monotonic() - start < 1
+        # 負けたプライマリは HTTP リクエストごとキャンセルされている
+        assert fake.cancelled == [0]
+        m = caller.metrics()
+        assert m["hedges"] == 1
+        assert m["hedge_wins"] == 1
+        assert m["win_rate"] == 1.0
+
+    asyncio.run(run())
+
+
+def test_hedge_wins_when_primary_fails_after_hedge_sent():
+    async def run():
+        caller = make_caller()
+        await prime(caller, 5)
+        fake = FakeCall(fail_soon, slow)
+        assert await caller.call(fake) == "slow-1"
+        m = caller.metrics()
+        assert m["hedges"] == 1
+        assert m["hedge_wins"] == 1
+
+    asyncio.run(run())
+
+
+def test_hedge_loses_and_is_cancelled():
+    async def run():
+        caller = make_caller()
+        await prime(caller, 5)
+        fake = FakeCall(slow, stall)
+        assert await caller.call(fake) == "slow-0"
+        assert fake.cancelled == [1]
+        m = caller.metrics()
+        assert m["hedges"] == 1
+        assert m["hedge_wins"] == 0
+        assert m["win_rate"] == 0.0
+
+    asyncio.run(run())
+
+
+def test_budget_caps_hedges_over_recent_window():
+    async def run():
+        # percentile=0.5 にして、遅い呼び出しは毎回ヘッジ対象になるようにする
+        caller = make_caller(percentile=0.5, window=50, budget_ratio=0.1)
+        # 長く空いた後でも、使わなかった予算は貯まらない
+        await prime(caller, 200)
+        for _ in range(20):
+            await caller.call(FakeCall(slow, fast))
+        m = caller.metrics()
+        assert m["calls"] == 220
+        assert m["hedges"] == 5
+        assert m["hedges"] <= 0.1 * (50 + 1)
+
+    asyncio.run(run())
+
+
+def test_timeout_raised_counted_and_cancelled():
+    async def run():
+        caller = make_caller(deadline_sec=0.2)
+        await prime(caller, 5)
+        fake = FakeCall(stall)
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            await caller.call(fake)
+        assert time.monotonic() - start < 1
+        # 締め切りを過ぎたリクエストは全部止まっている
+        assert sorted(fake.cancelled) == list(range(fake.count))
+        m = caller.metrics()
+        assert m["timeouts"] == 1
+        # タイムアウトした呼び出しも p99 に反映される
+        assert m["p99_sec"] >= 0.2
+
+    asyncio.run(run())
+
+
+def test_fast_primary_error_reraised_without_hedge():
+    async def run():
+        caller = make_caller()
+        await prime(caller, 5)
+        fake = FakeCall(boom)
+        with pytest.raises(ValueError):
+            await caller.call(fake)
+        assert fake.count == 1
+        assert caller.metrics()["hedges"] == 0
+
+    asyncio.run(run())
+
+
+def test_retryable_error_is_retried():
+    async def run():
+        caller = make_caller(retry_on=(Retryable,))
+        fake = FakeCall(busy, fast)
+        assert await caller.call(fake) == "fast-1"
+        assert caller.metrics()["retries"] == 1
+
+    asyncio.run(run())
+
+
+def test_retries_stop_at_max_attempts():
+    async def run():
+        caller = make_caller(retry_on=(Retryable,), max_attempts=3)
+        fake = FakeCall(busy)
+        with pytest.raises(Retryable):
+            await caller.call(fake)
+        assert fake.count == 3
+        assert caller.metrics()["retries"] == 2
+
+    asyncio.run(run())
+
+
+def test_retries_stop_before_deadline():
+    async def run():
+        caller = make_caller(retry_on=(Retryable,), max_attempts=10,
+                             deadline_sec=0.3, backoff_sec=0.2)
+        fake = FakeCall(busy)
+        with pytest.raises(Retryable):
+            await caller.call(fake)
+        # 0.2s 待って 2回目、次は 0.4s 待ちで締め切りを越えるので諦める
+        assert fake.count == 2
+
+    asyncio.run(run())
+
+
+def test_hedge_threshold_scales_with_work():
+    async def run():
+        caller = make_caller()
+        await prime(caller, 5)
+        # 20倍の入力なら 10倍遅くてもヘッジしない
+        fake = FakeCall(slow)
+        assert await caller.call(fake, work=20) == "slow-0"
+        assert fake.count == 1
+        assert caller.metrics()["hedges"] == 0
+
+    asyncio.run(run())